@@ -1,15 +1,82 @@
-import gradio as gr, tempfile, os, json, re
-from pypdf import PdfReader, PdfWriter, PageObject
-from helpers import parse_ranges, parse_final_order, pdf_page_to_thumbnail
+import gradio as gr, tempfile, os, json, functools, shutil, hashlib, mmap, gc
+from collections import OrderedDict
+from helpers import parse_ranges, parse_final_order, parse_order_runs, iter_thumbnails
+
+READER_CACHE_SIZE = 8
+PREVIEW_BATCH = 8  # galleries refresh after every this many thumbnails
 
 # --- Helpers ---
 def get_file_path(file_obj):
     """Normalize file path from Gradio File object."""
-    return file_obj.name if hasattr(file_obj, 'name') else file_obj
+    return getattr(file_obj, 'name', file_obj) if file_obj else None
+
+@functools.lru_cache(maxsize=32)
+def _file_digest(pdf_path, mtime, size):
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return hashlib.blake2b(mm, digest_size=16).hexdigest()
+
+_readers = OrderedDict()
+
+def get_reader(pdf_path):
+    """Return a cached PdfReader keyed by file content, so a re-upload of the same PDF reuses it."""
+    st = os.stat(pdf_path)
+    digest = _file_digest(pdf_path, st.st_mtime, st.st_size)
+    reader = _readers.pop(digest, None)
+    if reader is None:
+        from pypdf import PdfReader
+        reader = PdfReader(pdf_path)
+    _readers[digest] = reader
+    if len(_readers) > READER_CACHE_SIZE:
+        _readers.popitem(last=False)
+    return reader
+
+# Catalog entries writer.append drops that change how the document behaves, not just its metadata
+_DROPPED_BY_APPEND = ("/Outlines", "/AcroForm", "/Names", "/OpenAction")
+
+def _is_plain(reader):
+    """True if copying the file gives the same document writer.append would, metadata aside."""
+    return not reader.is_encrypted and not any(key in reader.root_object for key in _DROPPED_BY_APPEND)
+
+def _displayed_size(page):
+    """Width and height of the page's cropbox as a viewer shows it, after /Rotate."""
+    box = page.cropbox
+    w, h = float(box.width), float(box.height)
+    return (h, w) if page.rotation % 180 else (w, h)
+
+def _place_on_sheet(page, tx):
+    """Build the matrix mapping the page's cropbox, upright per /Rotate, to a sheet slot at x = tx."""
+    from pypdf import Transformation
+    box = page.cropbox
+    w, h = float(box.width), float(box.height)
+    ctm = Transformation().translate(tx=-float(box.left), ty=-float(box.bottom))
+    # /Rotate turns the page clockwise for display; apply the same turn to the content
+    rotation = page.rotation % 360
+    if rotation == 90:
+        ctm = ctm.rotate(-90).translate(tx=0, ty=w)
+    elif rotation == 180:
+        ctm = ctm.rotate(180).translate(tx=w, ty=h)
+    elif rotation == 270:
+        ctm = ctm.rotate(90).translate(tx=h, ty=0)
+    return ctm.translate(tx=tx, ty=0)
+
+def compose_2up(writer, pages):
+    """Places pages side by side, two per sheet, each with a single transformed merge."""
+    for i in range(0, len(pages), 2):
+        spread = pages[i:i + 2]
+        sizes = [_displayed_size(page) for page in spread]
+        sheet = writer.add_blank_page(
+            width=sum(w for w, _ in sizes),
+            height=max(h for _, h in sizes),
+        )
+        # pypdf clips each merged page to its trim box (the cropbox unless set)
+        offset = 0.0
+        for page, (w, _) in zip(spread, sizes):
+            sheet.merge_transformed_page(page, _place_on_sheet(page, offset))
+            offset += w
 
 # --- Core Functions ---
 def generate_single_pdf_preview(pdf_obj, range_str):
-    """Generates a gallery for a single PDF's selected pages."""
+    """Streams a gallery for a single PDF's selected pages as thumbnails are rendered."""
     preview_items = []
     pdf_path = get_file_path(pdf_obj)
 
@@ -21,17 +88,19 @@ def generate_single_pdf_preview(pdf_obj, range_str):
     except ValueError as e:
         raise gr.Error(f"Invalid page range: {e}")
 
-    for p in pages:
-        thumb = pdf_page_to_thumbnail(pdf_path, p)
+    thumbs = iter_thumbnails([(pdf_path, p) for p in pages])
+    for i, (p, thumb) in enumerate(zip(pages, thumbs), 1):
         if thumb:
             preview_items.append((thumb, f"Page {p}"))
         else:
             gr.Warning(f"Could not generate thumbnail for page {p}.")
+        if i % PREVIEW_BATCH == 0:
+            yield list(preview_items)
 
-    return preview_items
+    yield preview_items
 
 def generate_final_preview_gallery(pdf_a_obj, pdf_b_obj, order_str):
-    """Generates a gallery that reflects the sequence in the final_order textbox."""
+    """Streams a gallery that reflects the sequence in the final_order textbox."""
     preview_items = []
     pdf_paths = {"A": get_file_path(pdf_a_obj), "B": get_file_path(pdf_b_obj)}
 
@@ -43,21 +112,26 @@ def generate_final_preview_gallery(pdf_a_obj, pdf_b_obj, order_str):
     except ValueError as e:
         raise gr.Error(f"Invalid Final Order string: {e}")
 
-    for src, page in page_spec:
-        pdf_path = pdf_paths.get(src)
-        if not pdf_path:
+    # Check each source once; parse_order_runs is memoized, so this reuses the parse above
+    for src in dict.fromkeys(src for src, _, _ in parse_order_runs(order_str)):
+        if not pdf_paths.get(src):
             raise gr.Error(f"PDF for source '{src}' is missing. Please upload it again.")
-        
-        thumb = pdf_page_to_thumbnail(pdf_path, page)
+
+    thumbs = iter_thumbnails([(pdf_paths[src], page) for src, page in page_spec])
+    for i, ((src, page), thumb) in enumerate(zip(page_spec, thumbs), 1):
         if thumb:
             preview_items.append((thumb, f"{src}{page}"))
         else:
             gr.Warning(f"Could not generate thumbnail for {src}{page}.")
+        if i % PREVIEW_BATCH == 0:
+            yield list(preview_items)
 
-    return preview_items
+    yield preview_items
 
 def build_pdf_from_order(pdf_a_obj, pdf_b_obj, order_str, layout, output_filename):
     """Builds the final PDF based on the final_order string."""
+    # pypdf is imported on first build so start-up and preview-only sessions skip it
+    from pypdf import PdfWriter
     writer = PdfWriter()
     readers = {}
     pdf_paths = {"A": get_file_path(pdf_a_obj), "B": get_file_path(pdf_b_obj)}
@@ -65,37 +139,59 @@ def build_pdf_from_order(pdf_a_obj, pdf_b_obj, order_str, layout, output_filenam
     if not order_str.strip():
         raise gr.Error("The 'Final Order' text field is empty.")
 
+    # Work on runs directly so a contiguous range like A1-500 stays one entry
     try:
-        page_spec = parse_final_order(order_str)
+        runs = parse_order_runs(order_str)
     except ValueError as e:
         raise gr.Error(f"Invalid Final Order string: {e}")
 
-    for src, page in page_spec:
-        if src not in readers:
-            pdf_path = pdf_paths.get(src)
-            if not pdf_path:
-                raise gr.Error(f"PDF for source '{src}' is missing. Please upload it again.")
-            readers[src] = PdfReader(pdf_path)
-        
-        if not 0 < page <= len(readers[src].pages):
+    # Resolve every source once, before any page is touched
+    for src in dict.fromkeys(src for src, _, _ in runs):
+        pdf_path = pdf_paths.get(src)
+        if not pdf_path:
+            raise gr.Error(f"PDF for source '{src}' is missing. Please upload it again.")
+        readers[src] = get_reader(pdf_path)
+    num_pages = {src: len(reader.pages) for src, reader in readers.items()}
+
+    # Runs are ascending, so checking the endpoints covers every page
+    for src, first, last in runs:
+        if first < 1 or last > num_pages[src]:
+            page = first if first < 1 else max(first, num_pages[src] + 1)
             raise gr.Error(f"Page number {page} for PDF {src} is out of range.")
-            
-        writer.add_page(readers[src].pages[page - 1])
 
-    if not writer.pages:
+    if not runs:
         gr.Warning("No pages were added to the PDF.")
         return None
 
-    if layout == "2-Up":
-        gr.Warning("2-Up layout is not yet implemented. Generating a sequential PDF.")
-
     if not output_filename.lower().endswith(".pdf"):
         output_filename += ".pdf"
     
     # Create a temporary file with the desired filename in the system's temp directory
     tmp_filepath = os.path.join(tempfile.gettempdir(), output_filename)
-    with open(tmp_filepath, "wb") as f:
+
+    src, first, last = runs[0]
+    if (layout != "2-Up" and len(runs) == 1 and first == 1 and last == num_pages[src]
+            and _is_plain(readers[src])):
+        # The output is one whole, plain input: copy the file rather than re-serialize it
+        shutil.copyfile(pdf_paths[src], tmp_filepath)
+        return tmp_filepath
+
+    if layout == "2-Up":
+        pages = [readers[src].pages[p - 1] for src, first, last in runs for p in range(first, last + 1)]
+        compose_2up(writer, pages)
+    else:
+        # Copy each run of consecutive pages in one append call
+        for src, first, last in runs:
+            writer.append(readers[src], pages=(first - 1, last), import_outline=False)
+
+    # A large buffer coalesces pypdf's many small writes into few syscalls
+    with open(tmp_filepath, "wb", buffering=1 << 20) as f:
         writer.write(f)
+
+    # The writer's cloned object graph is cyclic; free it now instead of at the next GC pass
+    del writer
+    readers.clear()
+    gc.collect()
     return tmp_filepath
 
 # --- Gradio UI ---
@@ -124,7 +220,7 @@ with gr.Blocks(title="PDF Extract & Merge") as demo:
 
     gr.Markdown("## 3. Generate Final PDF")
     output_filename = gr.Textbox(label="Output Filename (e.g., merged.pdf)", value="merged.pdf")
-    layout = gr.Radio(["Sequential"], value="Sequential", label="Layout")
+    layout = gr.Radio(["Sequential", "2-Up"], value="Sequential", label="Layout")
     generate_btn = gr.Button("Generate PDF", variant="primary")
     result = gr.File(label="Merged PDF")
 
@@ -1,88 +1,190 @@
-import re, io, base64, tempfile, os
-from typing import List, Tuple
+import tempfile, os, threading, hashlib, functools, itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 import fitz                         # PyMuPDF
 from PIL import Image
 
-PAGE_RE  = re.compile(r"([AB])[:]?([0-9]+(?:-[0-9]+)?)", re.I)
-SEP_RE   = re.compile(r"[ ,;]+")
-RANGE_RE = re.compile(r"(\d+)-(\d+)")
+# Commas and semicolons separate tokens like spaces do; str.split() then tokenizes in C
+_SEP_TRANS = str.maketrans(",;", "  ")
+
+# MuPDF is not thread-safe: page rendering is serialized, JPEG encoding is not.
+_FITZ_LOCK = threading.Lock()
+
+# Open documents keyed by (path, mtime); the oldest is closed once the cache is full
+_DOC_CACHE: "OrderedDict[Tuple[str, float], fitz.Document]" = OrderedDict()
+DOC_CACHE_SIZE = 8
+
+THUMB_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdfmerge_thumbs")
+THUMB_WORKERS = 8  # renders share one lock; more threads would only queue on it
+THUMB_JPEG_QUALITY = 75  # baseline, non-optimized JPEG keeps the encoder on its fast path
+
+def _is_number(s: str) -> bool:
+    return s.isascii() and s.isdigit()
+
+def _parse_span(spec: str) -> Optional[Tuple[int, int]]:
+    """Parse "N" or "N-M" into an ascending (first, last) pair, or None if malformed."""
+    # Plain str checks beat the regex engine for tokens this small
+    lo, sep, hi = spec.partition("-")
+    if not _is_number(lo) or (sep and not _is_number(hi)):
+        return None
+    s, e = int(lo), int(hi) if sep else int(lo)
+    return (e, s) if s > e else (s, e) # Swap if order is reversed
 
 def parse_ranges(rng: str) -> List[int]:
-    pages: List[int] = []
+    spans: List[Tuple[int, int]] = []
     if not rng:
-        return pages
-    for part in SEP_RE.split(rng.strip()):
-        if not part:
-            continue
-        m = RANGE_RE.fullmatch(part)
-        if m:
-            s, e = map(int, m.groups())
-            if s > e:
-                s, e = e, s # Swap if order is reversed
+        return []
+    for part in rng.translate(_SEP_TRANS).split():
+        span = _parse_span(part)
+        if span is None:
+            raise ValueError(f"Invalid token '{part}'.")
+        spans.append(span)
+
+    # A single "N" or "N-M" is already sorted and unique
+    if len(spans) == 1:
+        s, e = spans[0]
+        return list(range(s, e + 1))
+
+    # Walk the spans in order, skipping overlaps, so every page is expanded
+    # exactly once without deduplicating or sorting the full page list
+    pages: List[int] = []
+    last = -1
+    for s, e in sorted(spans):
+        s = max(s, last + 1)
+        if s <= e:
             pages.extend(range(s, e + 1))
-        elif part.isdigit():
-            pages.append(int(part))
+            last = e
+    return pages
+
+@functools.lru_cache(maxsize=32)
+def parse_order_runs(order_str: str) -> Tuple[Tuple[str, int, int], ...]:
+    """Parse a final-order string into coalesced (src, first, last) runs without expanding ranges.
+
+    Memoized so the preview and generate handlers share one parse of the same string.
+    """
+    runs: List[Tuple[str, int, int]] = []
+    for token in order_str.translate(_SEP_TRANS).split():
+        # Tokens are "<A|B>[:]N[-M]"
+        src, spec = token[0].upper(), token[1:]
+        if spec.startswith(":"):
+            spec = spec[1:]
+        span = _parse_span(spec) if src in ("A", "B") else None
+        if span is None:
+            raise ValueError(f"Invalid order token '{token}'. Use e.g. A1 or B5-7.")
+        s, e = span
+        # Extend the previous run when this token continues it (A1-3, A4 -> A1-4)
+        if runs and runs[-1][0] == src and runs[-1][2] + 1 == s:
+            runs[-1] = (src, runs[-1][1], e)
         else:
-            raise ValueError(f"Invalid token '{part}'.")
-    return sorted(list(set(pages)))
+            runs.append((src, s, e))
+    return tuple(runs)
 
 def parse_final_order(order_str: str) -> List[Tuple[str, int]]:
     out: List[Tuple[str, int]] = []
-    for token in SEP_RE.split(order_str.strip()):
-        if not token:
-            continue
-        m = PAGE_RE.fullmatch(token)
-        if not m:
-            raise ValueError(f"Invalid order token '{token}'. Use e.g. A1 or B5-7.")
-        src, spec = m.groups()
-        src = src.upper()
-        if "-" in spec:
-            s, e = map(int, spec.split("-"))
-            if s > e:
-                s, e = e, s # Swap if order is reversed
-            out.extend([(src, p) for p in range(s, e + 1)])
-        else:
-            out.append((src, int(spec)))
+    for src, s, e in parse_order_runs(order_str):
+        out.extend(zip(itertools.repeat(src), range(s, e + 1)))
     return out
 
-def pdf_page_to_thumbnail(pdf_path: str, page_num: int, thumb_w: int = 160) -> str:
-    """Return temporary file path for page thumbnail."""
-    try:
+def _get_doc(pdf_path: str) -> fitz.Document:
+    """Return an open Document for pdf_path, reused until the file changes. Hold _FITZ_LOCK."""
+    key = (pdf_path, os.path.getmtime(pdf_path))
+    doc = _DOC_CACHE.pop(key, None)
+    if doc is None:
         doc = fitz.open(pdf_path)
-    except fitz.fitz.FitzError as e:
+    _DOC_CACHE[key] = doc
+    while len(_DOC_CACHE) > DOC_CACHE_SIZE:
+        _DOC_CACHE.popitem(last=False)[1].close()
+    return doc
+
+def _render_page(pdf_path: str, page_num: int, thumb_w: int, grayscale: bool) -> Optional[fitz.Pixmap]:
+    """Rasterize one page to a gray or RGB pixmap about thumb_w pixels wide, or None on failure."""
+    try:
+        doc = _get_doc(pdf_path)
+    except (OSError, RuntimeError) as e:
         print(f"Error opening PDF {pdf_path}: {e}")
-        return ""
+        return None
 
     if not (0 < page_num <= len(doc)):
         print(f"Page number {page_num} is out of range for PDF {pdf_path}.")
-        doc.close()
-        return ""
+        return None
         
     page = doc[page_num - 1]
 
     # Calculate the appropriate scaling factor
     if page.rect.width == 0:
-        doc.close()
-        return "" # Avoid division by zero for empty pages
-    
+        return None # Avoid division by zero for empty pages
+
     zoom = thumb_w / page.rect.width  # Zoom factor to make the width approx. thumb_w pixels
     mat = fitz.Matrix(zoom, zoom)
 
+    # Gray is 1 byte per pixel instead of 3 through render, encode and the JPEG itself
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+
     try:
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        return page.get_pixmap(matrix=mat, alpha=False, colorspace=colorspace)
     except (RuntimeError, ValueError) as e:
         print(f"Error generating thumbnail for page {page_num} of {pdf_path}: {e}")
-        doc.close()
-        return ""
+        return None
+
+def _write_thumbnail(pdf_path: str, page_num: int, thumb_w: int, grayscale: bool, tmp_dir: str) -> str:
+    """Render a page and encode it as JPEG into a new file in tmp_dir; return its path or ""."""
+    with _FITZ_LOCK:
+        pix = _render_page(pdf_path, page_num, thumb_w, grayscale)
+        if pix is None:
+            return ""
+        # frombytes copies the samples, so the pixmap can be freed here, while MuPDF is still locked
+        img = Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples_mv)
+        del pix
 
-    doc.close()
-    
-    # Save thumbnail to temporary file
+    # PIL releases the GIL while encoding, so pool workers compress in parallel
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-            img.save(tmp_file, format="PNG", optimize=True)
-            return tmp_file.name
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=".jpg", delete=False) as tmp_file:
+            img.save(tmp_file, format="JPEG", quality=THUMB_JPEG_QUALITY)
+        return tmp_file.name
     except Exception as e:
         print(f"Error saving thumbnail: {e}")
-        return ""
\ No newline at end of file
+        return ""
+
+def pdf_page_to_thumbnail(pdf_path: str, page_num: int, thumb_w: int = 160, grayscale: bool = True) -> str:
+    """Return the path of a cached JPEG thumbnail for the page, rendering it on a miss."""
+    try:
+        mtime = os.path.getmtime(pdf_path)
+    except OSError as e:
+        print(f"Error reading PDF {pdf_path}: {e}")
+        return ""
+    return _cached_thumb(pdf_path, mtime, page_num, thumb_w, grayscale)
+
+def _cached_thumb(pdf_path: str, mtime: float, page_num: int, thumb_w: int, grayscale: bool) -> str:
+    """Return the on-disk cached thumbnail for the page, rendering it if absent; "" on failure."""
+    key = hashlib.md5(f"{pdf_path}:{mtime}".encode()).hexdigest()
+    thumb_path = os.path.join(THUMB_CACHE_DIR, key, f"{page_num}_{thumb_w}{'_gray' if grayscale else ''}.jpg")
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    # Write under a unique name first so concurrent renders never expose a partial file
+    try:
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    except OSError as e:
+        print(f"Error saving thumbnail: {e}")
+        return ""
+    tmp_path = _write_thumbnail(pdf_path, page_num, thumb_w, grayscale, tmp_dir=os.path.dirname(thumb_path))
+    if not tmp_path:
+        return ""
+    try:
+        os.replace(tmp_path, thumb_path)
+    except OSError as e:
+        print(f"Error saving thumbnail: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return ""
+    return thumb_path
+
+def iter_thumbnails(jobs: List[Tuple[str, int]], thumb_w: int = 160, grayscale: bool = True) -> Iterator[str]:
+    """Yield cached thumbnail paths for (pdf_path, page_num) jobs in order, each as soon as it is ready."""
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=min(THUMB_WORKERS, len(jobs), os.cpu_count() or 1)) as pool:
+        yield from pool.map(lambda job: pdf_page_to_thumbnail(job[0], job[1], thumb_w, grayscale), jobs)